@@ -5,8 +5,10 @@ Usage: python add_job.py <job_id> <command>
 """
 
 import sys
-import subprocess
-import json
+from pathlib import Path
+
+from queue_manager import QueueManager
+from config import Config
 
 if len(sys.argv) < 3:
     print("Usage: python add_job.py <job_id> <command>")
@@ -16,22 +18,21 @@ if len(sys.argv) < 3:
 job_id = sys.argv[1]
 command = ' '.join(sys.argv[2:])
 
-job_data = {
-    "id": job_id,
-    "command": command
-}
-
-job_json = json.dumps(job_data)
-
-# Call queuectl.py enqueue
-result = subprocess.run(
-    ['python', 'queuectl.py', 'enqueue', job_json],
-    capture_output=True,
-    text=True
-)
-
-print(result.stdout)
-if result.stderr:
-    print(result.stderr, file=sys.stderr)
+BASE_DIR = Path.home() / ".queuectl"
+BASE_DIR.mkdir(exist_ok=True)
+
+queue_manager = QueueManager(BASE_DIR / "jobs.db")
+config = Config(BASE_DIR / "config.json")
+
+# Enqueue in-process; QueueManager fills in state and timestamps
+try:
+    queue_manager.enqueue_job({
+        "id": job_id,
+        "command": command,
+        "max_retries": config.get('max_retries')
+    })
+except Exception as e:
+    print(f"Error: {str(e)}", file=sys.stderr)
+    sys.exit(1)
 
-sys.exit(result.returncode)
+print(f"[OK] Job '{job_id}' enqueued successfully")
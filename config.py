@@ -2,9 +2,16 @@
 Configuration Manager - Handles persistent configuration
 """
 
+import atexit
 import json
+import os
 from pathlib import Path
 
+try:
+    import orjson  # Optional, faster JSON
+except ImportError:
+    orjson = None
+
 
 class Config:
     """Manages configuration with JSON persistence"""
@@ -15,25 +22,41 @@ class Config:
         'worker_timeout': 300
     }
     
-    def __init__(self, config_path):
+    def __init__(self, config_path, defer_writes=False):
+        """With defer_writes, set() only updates memory; changes are written
+        by flush(), which also runs at interpreter exit"""
         self.config_path = Path(config_path)
+        self.defer_writes = defer_writes
+        self._dirty = False
         self.config = self._load_config()
+        
+        if defer_writes:
+            atexit.register(self.flush)
     
     def _load_config(self):
         """Load configuration from file or create defaults"""
         if self.config_path.exists():
-            with open(self.config_path, 'r') as f:
-                config = json.load(f)
-                # Merge with defaults for any missing keys
-                return {**self.DEFAULT_CONFIG, **config}
+            if orjson:
+                config = orjson.loads(self.config_path.read_bytes())
+            else:
+                with open(self.config_path, 'r') as f:
+                    config = json.load(f)
+            # Merge with defaults for any missing keys
+            return {**self.DEFAULT_CONFIG, **config}
         else:
             self._save_config(self.DEFAULT_CONFIG)
             return self.DEFAULT_CONFIG.copy()
     
     def _save_config(self, config):
-        """Save configuration to file"""
-        with open(self.config_path, 'w') as f:
-            json.dump(config, f, indent=2)
+        """Save configuration to file atomically"""
+        # Write a temp file and swap it in, so readers never see a partial file
+        tmp_path = self.config_path.with_name(f"{self.config_path.name}.{os.getpid()}.tmp")
+        if orjson:
+            tmp_path.write_bytes(orjson.dumps(config, option=orjson.OPT_INDENT_2))
+        else:
+            with open(tmp_path, 'w') as f:
+                json.dump(config, f, indent=2)
+        os.replace(tmp_path, self.config_path)
     
     def get(self, key, default=None):
         """Get configuration value"""
@@ -42,7 +65,17 @@ class Config:
     def set(self, key, value):
         """Set configuration value"""
         self.config[key] = value
-        self._save_config(self.config)
+        
+        if self.defer_writes:
+            self._dirty = True
+        else:
+            self._save_config(self.config)
+    
+    def flush(self):
+        """Write pending changes made with defer_writes"""
+        if self._dirty:
+            self._save_config(self.config)
+            self._dirty = False
     
     def get_all(self):
         """Get all configuration values"""
@@ -4,222 +4,454 @@ Queue Manager - Handles job persistence and state management
 
 import sqlite3
 import json
+import time
 from datetime import datetime, timezone
-from threading import Lock
+from threading import Condition, Event, Lock, Thread, local
 from pathlib import Path
 
 
+def now_ms():
+    """Current UTC time as integer epoch milliseconds"""
+    return int(time.time() * 1000)
+
+
+def to_ms(value, default):
+    """Coerce a caller-supplied timestamp (epoch ms or ISO 8601 string) to epoch ms"""
+    if value is None:
+        return default
+    
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            pass
+        else:
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return int(parsed.timestamp() * 1000)
+    
+    raise Exception(f"Invalid timestamp: {value!r}")
+
+
+def format_timestamp(ms):
+    """Format epoch milliseconds as an ISO 8601 UTC string for display"""
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
 class QueueManager:
     """Manages job queue with SQLite persistence"""
     
+    STATS_TTL = 0.5  # seconds a get_stats() result is reused
+    
+    INSERT_JOB_SQL = '''
+        INSERT INTO jobs (id, command, state, attempts, max_retries,
+                         created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    # Timestamps are INTEGER epoch milliseconds
+    CREATE_JOBS_SQL = '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id TEXT PRIMARY KEY,
+            command TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            max_retries INTEGER DEFAULT 3,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            next_retry_at INTEGER,
+            error_message TEXT,
+            output TEXT
+        )
+    '''
+    
     def __init__(self, db_path):
         self.db_path = Path(db_path)
-        self.lock = Lock()
+        self._local = local()
+        self._connections = []
+        self._connections_lock = Lock()
+        self._stats_cache = None
+        self._new_job_cv = Condition()
+        self._checkpointer = None
+        self._checkpointer_stop = Event()
         self._init_db()
     
+    def _conn(self):
+        """Get this thread's long-lived connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        
+        if conn is None:
+            conn = sqlite3.connect(
+                self.db_path,
+                check_same_thread=False,
+                isolation_level=None,
+                cached_statements=256
+            )
+            
+            # Per-connection tuning; journal_mode=WAL is persistent and set in _init_db
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA cache_size=-65536')
+            conn.execute('PRAGMA mmap_size=268435456')
+            conn.execute('PRAGMA busy_timeout=5000')
+            conn.execute('PRAGMA wal_autocheckpoint=2000')
+            
+            self._local.conn = conn
+            
+            with self._connections_lock:
+                self._connections.append(conn)
+        
+        return conn
+    
+    def start_checkpointer(self, interval=30):
+        """Checkpoint the WAL from a background thread every `interval` seconds,
+        so commits rarely have to run a checkpoint themselves"""
+        if self._checkpointer:
+            return
+        
+        def run():
+            while not self._checkpointer_stop.wait(interval):
+                try:
+                    self._conn().execute('PRAGMA wal_checkpoint(PASSIVE)')
+                except sqlite3.Error as e:
+                    print(f"[checkpoint] WAL checkpoint failed: {e}")
+        
+        self._checkpointer_stop.clear()
+        self._checkpointer = Thread(target=run, daemon=True)
+        self._checkpointer.start()
+    
+    def close(self):
+        """Refresh planner stats, checkpoint the WAL and close all pooled connections"""
+        if self._checkpointer:
+            self._checkpointer_stop.set()
+            self._checkpointer.join()
+            self._checkpointer = None
+        
+        try:
+            conn = self._conn()
+            conn.execute('PRAGMA optimize')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error:
+            pass  # Best effort; the database is still consistent without it
+        
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._local = local()
+    
+    def wait_for_jobs(self, timeout):
+        """Block until a job is enqueued in this process or the timeout expires"""
+        with self._new_job_cv:
+            self._new_job_cv.wait(timeout)
+    
+    def notify_new_jobs(self):
+        """Wake up workers waiting in wait_for_jobs()"""
+        with self._new_job_cv:
+            self._new_job_cv.notify_all()
+    
     def _init_db(self):
         """Initialize SQLite database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS jobs (
-                id TEXT PRIMARY KEY,
-                command TEXT NOT NULL,
-                state TEXT NOT NULL,
-                attempts INTEGER DEFAULT 0,
-                max_retries INTEGER DEFAULT 3,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                next_retry_at TEXT,
-                error_message TEXT,
-                output TEXT
-            )
+        conn = self._conn()
+        
+        # WAL lets readers run concurrently with a writer and saves an fsync per commit
+        conn.execute('PRAGMA journal_mode=WAL')
+        
+        conn.execute(self.CREATE_JOBS_SQL.format(table='jobs'))
+        self._migrate_text_timestamps(conn)
+        
+        # Claim query walks each runnable state in created_at order. Replaces an
+        # older (state, next_retry_at, created_at) index that could not serve it
+        conn.execute('DROP INDEX IF EXISTS idx_jobs_claim')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_jobs_state_created
+            ON jobs (state, created_at)
         ''')
         
-        conn.commit()
-        conn.close()
+        # list_jobs filtered by state, newest first
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_jobs_state_updated
+            ON jobs (state, updated_at DESC)
+        ''')
+        
+        # get_stats() is a covering scan of either index above; a separate
+        # (state) index only added write cost, so drop it from older databases
+        conn.execute('DROP INDEX IF EXISTS idx_jobs_state')
+        
+        # Gather planner statistics the first time this database is opened
+        has_stats = conn.execute('''
+            SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'
+        ''').fetchone()
+        
+        if not has_stats:
+            conn.execute('ANALYZE')
+    
+    def _migrate_text_timestamps(self, conn):
+        """Rebuild a jobs table created with TEXT ISO timestamps as epoch ms"""
+        def has_text_timestamps():
+            columns = {row[1]: row[2] for row in conn.execute('PRAGMA table_info(jobs)')}
+            return columns['created_at'] == 'TEXT'
+        
+        def julianday_ms(column):
+            return f"CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+        
+        if not has_text_timestamps():
+            return
+        
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have migrated while we waited for the lock
+            if not has_text_timestamps():
+                conn.rollback()
+                return
+            
+            # Dropping the old table drops its indexes; _init_db recreates them.
+            # Text julianday() can't parse becomes NULL, so required columns fall back to now
+            conn.execute(self.CREATE_JOBS_SQL.format(table='jobs_migrated'))
+            conn.execute(f'''
+                INSERT INTO jobs_migrated
+                SELECT id, command, state, attempts, max_retries,
+                       COALESCE({julianday_ms('created_at')}, :now),
+                       COALESCE({julianday_ms('updated_at')}, :now),
+                       {julianday_ms('next_retry_at')},
+                       error_message, output
+                FROM jobs
+            ''', {'now': now_ms()})
+            conn.execute('DROP TABLE jobs')
+            conn.execute('ALTER TABLE jobs_migrated RENAME TO jobs')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _job_row(self, job_data, now):
+        """Build the INSERT parameters for a job dict; only id and command are required"""
+        return (
+            job_data['id'],
+            job_data['command'],
+            job_data.get('state', 'pending'),
+            job_data.get('attempts', 0),
+            job_data.get('max_retries', 3),
+            to_ms(job_data.get('created_at'), now),
+            to_ms(job_data.get('updated_at'), now)
+        )
     
     def enqueue_job(self, job_data):
         """Add a new job to the queue"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            try:
-                cursor.execute('''
-                    INSERT INTO jobs (id, command, state, attempts, max_retries, 
-                                     created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    job_data['id'],
-                    job_data['command'],
-                    job_data.get('state', 'pending'),
-                    job_data.get('attempts', 0),
-                    job_data.get('max_retries', 3),
-                    job_data['created_at'],
-                    job_data['updated_at']
-                ))
-                
-                conn.commit()
-            except sqlite3.IntegrityError:
-                raise Exception(f"Job with id '{job_data['id']}' already exists")
-            finally:
-                conn.close()
+        conn = self._conn()
+        
+        try:
+            conn.execute(self.INSERT_JOB_SQL, self._job_row(job_data, now_ms()))
+        except sqlite3.IntegrityError:
+            raise Exception(f"Job with id '{job_data['id']}' already exists")
+        
+        self.notify_new_jobs()
+    
+    def enqueue_many(self, jobs):
+        """Add many jobs in a single transaction; nothing is inserted on error"""
+        now = now_ms()
+        rows = [self._job_row(job_data, now) for job_data in jobs]
+        conn = self._conn()
+        
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(self.INSERT_JOB_SQL, rows)
+            conn.commit()
+        except sqlite3.IntegrityError as e:
+            conn.rollback()
+            raise Exception(self._batch_conflict([row[0] for row in rows]) or f"Batch rejected: {e}")
+        except Exception:
+            conn.rollback()
+            raise
+        
+        self.notify_new_jobs()
+        return len(rows)
+    
+    def _batch_conflict(self, ids):
+        """Describe the first id repeated in a batch or already queued, else None"""
+        seen = set()
+        for job_id in ids:
+            if job_id in seen:
+                return f"Job id '{job_id}' appears more than once in the batch"
+            seen.add(job_id)
+        
+        # Chunked so the IN list stays under SQLite's host parameter limit
+        conn = self._conn()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            row = conn.execute(
+                f'SELECT id FROM jobs WHERE id IN ({placeholders}) LIMIT 1', chunk
+            ).fetchone()
+            if row:
+                return f"Job with id '{row[0]}' already exists"
+        return None
     
     def get_next_job(self, worker_id):
-        """Get next pending job and mark as processing"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            try:
-                # Get jobs that are pending or failed with retry time passed
-                now = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
-                
-                cursor.execute('''
-                    SELECT * FROM jobs 
-                    WHERE state = 'pending' 
-                       OR (state = 'failed' AND (next_retry_at IS NULL OR next_retry_at <= ?))
-                    ORDER BY created_at ASC
-                    LIMIT 1
-                ''', (now,))
-                
-                row = cursor.fetchone()
-                
-                if row:
-                    job = dict(row)
-                    
-                    # Mark as processing
-                    cursor.execute('''
-                        UPDATE jobs 
-                        SET state = 'processing', updated_at = ?
-                        WHERE id = ?
-                    ''', (now, job['id']))
-                    
-                    conn.commit()
-                    return job
-                
-                return None
-                
-            finally:
-                conn.close()
+        """Atomically claim the next runnable job and mark it as processing"""
+        conn = self._conn()
+        
+        # Oldest job that is pending or failed with retry time passed; the subquery
+        # and update run as one statement, so two workers never claim the same row.
+        # Each state gets its own branch so both are ordered index searches on
+        # idx_jobs_state_created that stop at the first row. INDEXED BY pins the
+        # index: when ANALYZE sees most rows pending, the planner would otherwise
+        # pick a full scan plus sort
+        now = now_ms()
+        
+        rows = conn.execute('''
+            UPDATE jobs
+            SET state = 'processing', updated_at = ?
+            WHERE id = (
+                SELECT id FROM (
+                    SELECT * FROM (
+                        SELECT id, created_at FROM jobs INDEXED BY idx_jobs_state_created
+                        WHERE state = 'pending'
+                        ORDER BY created_at ASC
+                        LIMIT 1
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT id, created_at FROM jobs INDEXED BY idx_jobs_state_created
+                        WHERE state = 'failed'
+                          AND (next_retry_at IS NULL OR next_retry_at <= ?)
+                        ORDER BY created_at ASC
+                        LIMIT 1
+                    )
+                )
+                ORDER BY created_at ASC
+                LIMIT 1
+            )
+            RETURNING id, command, attempts, max_retries
+        ''', (now, now)).fetchall()
+        
+        if not rows:
+            return None
+        
+        # Only the columns the worker reads
+        job_id, command, attempts, max_retries = rows[0]
+        return {
+            'id': job_id,
+            'command': command,
+            'attempts': attempts,
+            'max_retries': max_retries
+        }
     
-    def update_job(self, job_id, updates):
-        """Update job fields"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            try:
-                updates['updated_at'] = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
-                
-                set_clause = ', '.join([f"{k} = ?" for k in updates.keys()])
-                values = list(updates.values()) + [job_id]
-                
-                cursor.execute(f'''
-                    UPDATE jobs SET {set_clause}
-                    WHERE id = ?
-                ''', values)
-                
-                conn.commit()
-            finally:
-                conn.close()
+    def mark_completed(self, job_id, output):
+        """Mark a job as successfully completed"""
+        now = now_ms()
+        
+        self._conn().execute('''
+            UPDATE jobs
+            SET state = 'completed', output = ?, updated_at = ?
+            WHERE id = ?
+        ''', (output, now, job_id))
+    
+    def mark_failed_retry(self, job_id, attempts, next_retry_at, error_message):
+        """Mark a job as failed and schedule its next retry"""
+        now = now_ms()
+        
+        self._conn().execute('''
+            UPDATE jobs
+            SET state = 'failed', attempts = ?, next_retry_at = ?,
+                error_message = ?, updated_at = ?
+            WHERE id = ?
+        ''', (attempts, next_retry_at, error_message, now, job_id))
+    
+    def mark_dead(self, job_id, attempts, error_message):
+        """Move a job to the Dead Letter Queue"""
+        now = now_ms()
+        
+        self._conn().execute('''
+            UPDATE jobs
+            SET state = 'dead', attempts = ?, error_message = ?, updated_at = ?
+            WHERE id = ?
+        ''', (attempts, error_message, now, job_id))
     
     def get_job(self, job_id):
         """Get job by ID"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        conn = self._conn()
         
-        try:
-            cursor.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
-        finally:
-            conn.close()
+        cursor = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        row = cursor.fetchone()
+        
+        if not row:
+            return None
+        
+        return dict(zip([col[0] for col in cursor.description], row))
     
     def list_jobs(self, state=None, limit=20):
-        """List jobs, optionally filtered by state"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        """List jobs as (id, state, command, attempts, updated_at) tuples"""
+        conn = self._conn()
         
-        try:
-            if state:
-                cursor.execute('''
-                    SELECT * FROM jobs WHERE state = ? 
-                    ORDER BY updated_at DESC LIMIT ?
-                ''', (state, limit))
-            else:
-                cursor.execute('''
-                    SELECT * FROM jobs 
-                    ORDER BY updated_at DESC LIMIT ?
-                ''', (limit,))
-            
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
-        finally:
-            conn.close()
+        if state:
+            cursor = conn.execute('''
+                SELECT id, state, command, attempts, updated_at
+                FROM jobs WHERE state = ?
+                ORDER BY updated_at DESC LIMIT ?
+            ''', (state, limit))
+        else:
+            cursor = conn.execute('''
+                SELECT id, state, command, attempts, updated_at
+                FROM jobs
+                ORDER BY updated_at DESC LIMIT ?
+            ''', (limit,))
+        
+        return cursor.fetchall()
     
     def get_stats(self):
         """Get job statistics"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cached = self._stats_cache
+        if cached and time.monotonic() - cached[0] < self.STATS_TTL:
+            return cached[1].copy()
         
-        try:
-            cursor.execute('''
-                SELECT state, COUNT(*) as count 
-                FROM jobs 
-                GROUP BY state
-            ''')
-            
-            stats = {
-                'pending': 0,
-                'processing': 0,
-                'completed': 0,
-                'failed': 0,
-                'dead': 0,
-                'total': 0
-            }
-            
-            for row in cursor.fetchall():
-                state, count = row
-                stats[state] = count
-                stats['total'] += count
-            
-            return stats
-        finally:
-            conn.close()
+        conn = self._conn()
+        
+        cursor = conn.execute('''
+            SELECT state, COUNT(*) as count
+            FROM jobs
+            GROUP BY state
+        ''')
+        
+        stats = {
+            'pending': 0,
+            'processing': 0,
+            'completed': 0,
+            'failed': 0,
+            'dead': 0,
+            'total': 0
+        }
+        
+        for row in cursor.fetchall():
+            state, count = row
+            stats[state] = count
+            stats['total'] += count
+        
+        self._stats_cache = (time.monotonic(), stats)
+        return stats.copy()
     
     def retry_dlq_job(self, job_id):
         """Move job from DLQ back to pending"""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+        conn = self._conn()
+        
+        now = now_ms()
+        cursor = conn.execute('''
+            UPDATE jobs
+            SET state = 'pending', attempts = 0, next_retry_at = NULL,
+                updated_at = ?, error_message = NULL
+            WHERE id = ? AND state = 'dead'
+        ''', (now, job_id))
+        
+        if cursor.rowcount == 0:
+            # Only the error path needs to know why nothing was updated
+            row = conn.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
             
-            try:
-                cursor.execute('''
-                    SELECT state FROM jobs WHERE id = ?
-                ''', (job_id,))
-                
-                row = cursor.fetchone()
-                
-                if not row:
-                    raise Exception(f"Job '{job_id}' not found")
-                
-                if row[0] != 'dead':
-                    raise Exception(f"Job '{job_id}' is not in DLQ (current state: {row[0]})")
-                
-                now = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
-                cursor.execute('''
-                    UPDATE jobs 
-                    SET state = 'pending', attempts = 0, next_retry_at = NULL, 
-                        updated_at = ?, error_message = NULL
-                    WHERE id = ?
-                ''', (now, job_id))
-                
-                conn.commit()
-            finally:
-                conn.close()
+            if not row:
+                raise Exception(f"Job '{job_id}' not found")
+            
+            raise Exception(f"Job '{job_id}' is not in DLQ (current state: {row[0]})")
+        
+        self.notify_new_jobs()
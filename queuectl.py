@@ -5,21 +5,120 @@ Main entry point for the CLI application
 """
 
 import click
+import functools
 import json
 import sys
 from pathlib import Path
-from datetime import datetime, timezone
 
-from queue_manager import QueueManager
-from worker import Worker
-from config import Config
+try:
+    import orjson  # Optional, faster JSON parsing for enqueue/enqueue-file
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Initialize paths
 BASE_DIR = Path.home() / ".queuectl"
-BASE_DIR.mkdir(exist_ok=True)
 
-queue_manager = QueueManager(BASE_DIR / "jobs.db")
-config = Config(BASE_DIR / "config.json")
+
+# The queue, worker and config modules are imported and opened on first use,
+# so commands like --help never touch SQLite or the config file
+def base_dir():
+    """Data directory, created on first use"""
+    BASE_DIR.mkdir(exist_ok=True)
+    return BASE_DIR
+
+
+def workers_file():
+    """Status file of the running `worker start`: {"pid": ..., "count": ...}"""
+    return base_dir() / "workers.json"
+
+
+def pid_alive(pid):
+    """Whether a process with this PID is running"""
+    import os
+    
+    if os.name == 'nt':  # Windows: os.kill(pid, 0) would send CTRL_C_EVENT
+        import ctypes
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == STILL_ACTIVE
+    
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_workers_file():
+    """Contents of workers.json, or None if it is missing, corrupt or incomplete"""
+    try:
+        running = json.loads(workers_file().read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+    
+    if not (isinstance(running, dict) and isinstance(running.get('pid'), int)
+            and isinstance(running.get('count'), int)):
+        return None
+    return running
+
+
+def write_workers_file(pid, count):
+    """Write workers.json atomically, so readers never see a partial file"""
+    import os
+    
+    status_file = workers_file()
+    tmp_path = status_file.with_name(f"{status_file.name}.{pid}.tmp")
+    tmp_path.write_text(json.dumps({'pid': pid, 'count': count}))
+    os.replace(tmp_path, status_file)
+
+
+def lock_workers():
+    """Take the workers lock without blocking; returns its fd, or None if held.
+    
+    `worker start` holds it for its whole run. The OS drops the lock when the
+    process exits, even on a crash, so a stale lock never blocks a new start.
+    """
+    import os
+    
+    # Not inherited by job subprocesses (fds are non-inheritable by default)
+    fd = os.open(base_dir() / "workers.lock", os.O_RDWR | os.O_CREAT)
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+@functools.lru_cache(maxsize=None)
+def qm():
+    """Shared QueueManager for this invocation"""
+    from queue_manager import QueueManager
+    return QueueManager(base_dir() / "jobs.db")
+
+
+@functools.lru_cache(maxsize=None)
+def cfg():
+    """Shared Config for this invocation"""
+    from config import Config
+    return Config(base_dir() / "config.json")
 
 
 @click.group()
@@ -28,25 +127,24 @@ def cli():
     pass
 
 
+def apply_job_defaults(job_data):
+    """Fill in config-dependent defaults; QueueManager fills state and timestamps"""
+    job_data.setdefault('max_retries', cfg().get('max_retries'))
+    return job_data
+
+
 @cli.command()
 @click.argument('job_json')
 def enqueue(job_json):
     """Enqueue a new job. Example: queuectl enqueue '{"id":"job1","command":"sleep 2"}'"""
     try:
-        job_data = json.loads(job_json)
+        job_data = json_loads(job_json)
         
         if 'id' not in job_data or 'command' not in job_data:
             click.echo("Error: Job must have 'id' and 'command' fields", err=True)
             sys.exit(1)
         
-        # Set defaults
-        job_data.setdefault('state', 'pending')
-        job_data.setdefault('attempts', 0)
-        job_data.setdefault('max_retries', config.get('max_retries'))
-        job_data.setdefault('created_at', datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'))
-        job_data.setdefault('updated_at', datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'))
-        
-        queue_manager.enqueue_job(job_data)
+        qm().enqueue_job(apply_job_defaults(job_data))
         click.echo(f"[OK] Job '{job_data['id']}' enqueued successfully")
         
     except json.JSONDecodeError:
@@ -57,23 +155,70 @@ def enqueue(job_json):
         sys.exit(1)
 
 
+@cli.command(name='enqueue-file')
+@click.argument('jobs_file', type=click.File('r'))
+@click.option('--batch-size', default=10000, help='Jobs inserted per transaction')
+def enqueue_file(jobs_file, batch_size):
+    """Enqueue jobs from a JSONL file (one job object per line)"""
+    batch = []
+    total = 0
+    
+    try:
+        for line_no, line in enumerate(jobs_file, 1):
+            if not line.strip():
+                continue
+            
+            try:
+                job_data = json_loads(line)
+            except json.JSONDecodeError:
+                raise Exception(f"Invalid JSON on line {line_no}")
+            
+            if 'id' not in job_data or 'command' not in job_data:
+                raise Exception(f"Job on line {line_no} must have 'id' and 'command' fields")
+            
+            batch.append(apply_job_defaults(job_data))
+            
+            if len(batch) >= batch_size:
+                total += qm().enqueue_many(batch)
+                batch = []
+        
+        if batch:
+            total += qm().enqueue_many(batch)
+        
+        click.echo(f"[OK] {total} job(s) enqueued successfully")
+        
+    except Exception as e:
+        click.echo(f"Error: {str(e)} ({total} job(s) enqueued before the error)", err=True)
+        sys.exit(1)
+
+
 @cli.group()
 def worker():
-    """Manage worker processes"""
+    """Manage worker threads"""
     pass
 
 
 @worker.command()
 @click.option('--count', default=1, help='Number of workers to start')
-def start(count):
-    """Start worker processes"""
+@click.option('--concurrency', default=1, help='Jobs each worker runs at the same time')
+def start(count, concurrency):
+    """Start worker threads sharing one queue manager"""
     import os
     import signal
+    from worker import Worker
+    
+    # Only one `worker start` per data directory, so workers.json describes all workers
+    lock = lock_workers()
+    if lock is None:
+        running = read_workers_file()
+        pid = f" (PID: {running['pid']})" if running else ""
+        click.echo(f"Error: Workers already running{pid}. "
+                   "Stop them first with 'worker stop'", err=True)
+        sys.exit(1)
     
-    if os.name == 'nt':  # Windows
-        click.echo("Warning: Multiple workers not fully supported on Windows.")
-        click.echo("  Starting single worker instead.")
-        count = 1
+    # All workers are threads of this process, so one status file covers them.
+    # With the lock held, any existing workers.json is stale and is replaced
+    write_workers_file(os.getpid(), count)
     
     click.echo(f"Starting {count} worker(s)...")
     click.echo("Press Ctrl+C to stop gracefully (may take a moment).\n")
@@ -87,16 +232,20 @@ def start(count):
         click.echo("[OK] All workers stopped")
         sys.exit(0)
     
-    # Register signal handler
+    # Register signal handlers; `worker stop` sends SIGTERM
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    qm().start_checkpointer()
     
     try:
         for i in range(count):
             w = Worker(
                 worker_id=f"worker-{i+1}",
-                queue_manager=queue_manager,
-                config=config,
-                base_dir=BASE_DIR
+                queue_manager=qm(),
+                config=cfg(),
+                base_dir=base_dir(),
+                concurrency=concurrency
             )
             w.start()
             workers.append(w)
@@ -117,37 +266,45 @@ def start(count):
         for w in workers:
             w.stop()
         click.echo("[OK] All workers stopped")
+    finally:
+        # Remove the status file before releasing the lock; it is ours while we hold it
+        workers_file().unlink(missing_ok=True)
+        os.close(lock)
+        qm().close()
 
 
 @worker.command()
 def stop():
     """Stop all running workers"""
-    pid_file = BASE_DIR / "workers.pid"
-    
-    if not pid_file.exists():
-        click.echo("No workers running")
-        return
-    
     import signal
     import os
     
-    with open(pid_file, 'r') as f:
-        pids = [int(line.strip()) for line in f if line.strip()]
+    lock = lock_workers()
+    if lock is not None:
+        # Nothing holds the lock, so no workers are running; clear any leftover file
+        status_file = workers_file()
+        if status_file.exists():
+            status_file.unlink()
+            click.echo("[WARN] No workers running; removed stale workers.json")
+        else:
+            click.echo("No workers running")
+        os.close(lock)
+        return
     
-    for pid in pids:
-        try:
-            os.kill(pid, signal.SIGTERM)
-            click.echo(f"[OK] Sent stop signal to worker (PID: {pid})")
-        except ProcessLookupError:
-            click.echo(f"[WARN] Worker (PID: {pid}) not found")
+    running = read_workers_file()
+    if not running:
+        click.echo("Error: Workers are running but workers.json is missing or unreadable", err=True)
+        sys.exit(1)
     
-    pid_file.unlink()
+    pid = running['pid']
+    os.kill(pid, signal.SIGTERM)
+    click.echo(f"[OK] Sent stop signal to workers (PID: {pid})")
 
 
 @cli.command()
 def status():
     """Show summary of job states and active workers"""
-    stats = queue_manager.get_stats()
+    stats = qm().get_stats()
     
     click.echo("\n=== QueueCTL Status ===\n")
     click.echo("Job States:")
@@ -159,11 +316,9 @@ def status():
     click.echo(f"\n  Total Jobs: {stats['total']}")
     
     # Worker info
-    pid_file = BASE_DIR / "workers.pid"
-    if pid_file.exists():
-        with open(pid_file, 'r') as f:
-            active_workers = len([l for l in f if l.strip()])
-        click.echo(f"\nActive Workers: {active_workers}")
+    running = read_workers_file()
+    if running and pid_alive(running['pid']):
+        click.echo(f"\nActive Workers: {running['count']}")
     else:
         click.echo("\nActive Workers: 0")
 
@@ -173,7 +328,9 @@ def status():
 @click.option('--limit', default=20, help='Maximum number of jobs to display')
 def list(state, limit):
     """List jobs by state"""
-    jobs = queue_manager.list_jobs(state, limit)
+    from queue_manager import format_timestamp
+    
+    jobs = qm().list_jobs(state, limit)
     
     if not jobs:
         click.echo(f"No jobs found" + (f" with state '{state}'" if state else ""))
@@ -182,10 +339,10 @@ def list(state, limit):
     click.echo(f"\n{'ID':<20} {'State':<12} {'Command':<30} {'Attempts':<10} {'Updated':<20}")
     click.echo("=" * 100)
     
-    for job in jobs:
-        cmd = job['command'][:27] + '...' if len(job['command']) > 30 else job['command']
-        updated = job['updated_at'][:19] if job['updated_at'] else 'N/A'
-        click.echo(f"{job['id']:<20} {job['state']:<12} {cmd:<30} {job['attempts']:<10} {updated:<20}")
+    for job_id, job_state, command, attempts, updated_at in jobs:
+        cmd = command[:27] + '...' if len(command) > 30 else command
+        updated = format_timestamp(updated_at)[:19] if updated_at else 'N/A'
+        click.echo(f"{job_id:<20} {job_state:<12} {cmd:<30} {attempts:<10} {updated:<20}")
 
 
 @cli.group()
@@ -198,7 +355,9 @@ def dlq():
 @click.option('--limit', default=20, help='Maximum number of jobs to display')
 def list(limit):
     """List jobs in DLQ"""
-    jobs = queue_manager.list_jobs('dead', limit)
+    from queue_manager import format_timestamp
+    
+    jobs = qm().list_jobs('dead', limit)
     
     if not jobs:
         click.echo("DLQ is empty")
@@ -207,10 +366,10 @@ def list(limit):
     click.echo(f"\n{'ID':<20} {'Command':<30} {'Attempts':<10} {'Updated':<20}")
     click.echo("=" * 90)
     
-    for job in jobs:
-        cmd = job['command'][:27] + '...' if len(job['command']) > 30 else job['command']
-        updated = job['updated_at'][:19] if job['updated_at'] else 'N/A'
-        click.echo(f"{job['id']:<20} {cmd:<30} {job['attempts']:<10} {updated:<20}")
+    for job_id, _, command, attempts, updated_at in jobs:
+        cmd = command[:27] + '...' if len(command) > 30 else command
+        updated = format_timestamp(updated_at)[:19] if updated_at else 'N/A'
+        click.echo(f"{job_id:<20} {cmd:<30} {attempts:<10} {updated:<20}")
 
 
 @dlq.command()
@@ -218,7 +377,7 @@ def list(limit):
 def retry(job_id):
     """Retry a job from DLQ"""
     try:
-        queue_manager.retry_dlq_job(job_id)
+        qm().retry_dlq_job(job_id)
         click.echo(f"[OK] Job '{job_id}' moved back to queue for retry")
     except Exception as e:
         click.echo(f"Error: {str(e)}", err=True)
@@ -243,7 +402,7 @@ def config_set(key, value):
         elif value.replace('.', '', 1).isdigit():
             value = float(value)
         
-        config.set(key.replace('-', '_'), value)
+        cfg().set(key.replace('-', '_'), value)
         click.echo(f"[OK] Configuration updated: {key} = {value}")
     except Exception as e:
         click.echo(f"Error: {str(e)}", err=True)
@@ -255,12 +414,12 @@ def config_set(key, value):
 def config_get(key):
     """Get configuration value(s)"""
     if key:
-        value = config.get(key.replace('-', '_'))
+        value = cfg().get(key.replace('-', '_'))
         click.echo(f"{key}: {value}")
     else:
         click.echo("\nCurrent Configuration:")
         click.echo("=" * 40)
-        for k, v in config.get_all().items():
+        for k, v in cfg().get_all().items():
             click.echo(f"  {k.replace('_', '-')}: {v}")
 
 
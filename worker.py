@@ -2,22 +2,41 @@
 Worker - Executes jobs from the queue
 """
 
-import subprocess
-import time
-from datetime import datetime, timedelta, timezone
+import asyncio
+import hashlib
+import re
+from pathlib import Path
 from threading import Thread, Event
 import signal
 import sys
 
+from queue_manager import now_ms
+
 
 class Worker:
-    """Worker process that executes jobs"""
+    """Worker thread that executes jobs"""
+    
+    # Upper bound on how long an idle worker waits before re-checking the queue.
+    # In-process enqueues wake it immediately; this catches jobs enqueued by
+    # other processes and failed jobs whose retry time has come.
+    POLL_INTERVAL = 1
+    
+    # Only the end of a job's output is stored in the database; the full
+    # output stays in its log file under <base_dir>/logs
+    OUTPUT_TAIL_BYTES = 4096
     
-    def __init__(self, worker_id, queue_manager, config, base_dir):
+    def __init__(self, worker_id, queue_manager, config, base_dir, concurrency=1):
         self.worker_id = worker_id
         self.queue_manager = queue_manager
         self.config = config
+        # Config doesn't change while a worker runs; read it once
+        self._backoff_base = config.get('backoff_base')
+        self._max_retries_default = config.get('max_retries')
+        self._timeout = config.get('worker_timeout', 300)
         self.base_dir = base_dir
+        self.concurrency = concurrency
+        self.log_dir = Path(base_dir) / "logs"
+        self.log_dir.mkdir(parents=True, exist_ok=True)
         self.thread = None
         self.stop_event = Event()
         self.running = False
@@ -30,6 +49,7 @@ class Worker:
     def stop(self):
         """Stop the worker thread gracefully"""
         self.stop_event.set()
+        self.queue_manager.notify_new_jobs()
         if self.thread:
             self.thread.join(timeout=10)
     
@@ -39,90 +59,134 @@ class Worker:
             self.thread.join()
     
     def _run(self):
-        """Main worker loop"""
+        """Thread entry point; runs the worker's event loop"""
+        asyncio.run(self._main())
+    
+    async def _db(self, func, *args):
+        """Run a blocking queue manager call off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+    
+    async def _main(self):
+        """Main worker loop; runs up to `concurrency` jobs at once"""
         self.running = True
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
         
         print(f"[{self.worker_id}] Worker started")
         
         while self.running and not self.stop_event.is_set():
+            await slots.acquire()
+            
+            # Stop may have been requested while waiting for a free slot
+            if self.stop_event.is_set():
+                slots.release()
+                break
+            
             try:
-                job = self.queue_manager.get_next_job(self.worker_id)
+                job = await self._db(self.queue_manager.get_next_job, self.worker_id)
                 
                 if job:
-                    self._execute_job(job)
+                    task = asyncio.ensure_future(self._execute_job(job, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
                 else:
-                    time.sleep(1)  # No jobs available, wait
+                    slots.release()
+                    # No jobs available, wait for an enqueue or the next poll
+                    await self._db(self.queue_manager.wait_for_jobs, self.POLL_INTERVAL)
                     
-            except KeyboardInterrupt:
-                print(f"\n[{self.worker_id}] Received shutdown signal, finishing current job...")
-                self.running = False
-                break
             except Exception as e:
+                slots.release()
                 print(f"[{self.worker_id}] Error in worker loop: {e}")
-                time.sleep(1)
+                await asyncio.sleep(1)
+        
+        if tasks:
+            print(f"[{self.worker_id}] Finishing {len(tasks)} running job(s)...")
+            await asyncio.gather(*tasks, return_exceptions=True)
         
         print(f"[{self.worker_id}] Worker stopped")
     
-    def _execute_job(self, job):
-        """Execute a single job"""
+    def _log_path(self, job_id):
+        """Log file for a job: the id with unsafe characters replaced and cut to
+        100 characters, plus a short hash of the raw id so ids that sanitize or
+        truncate alike don't collide"""
+        safe_id = re.sub(r'[^A-Za-z0-9._-]', '_', job_id)[:100]
+        digest = hashlib.sha1(job_id.encode()).hexdigest()[:8]
+        return self.log_dir / f"{safe_id}-{digest}.log"
+    
+    def _read_tail(self, path):
+        """Return the last OUTPUT_TAIL_BYTES of a log file as text"""
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            f.seek(max(0, f.tell() - self.OUTPUT_TAIL_BYTES))
+            return f.read().decode(errors='replace')
+    
+    async def _execute_job(self, job, slots):
+        """Execute a single job, releasing its concurrency slot when done"""
         job_id = job['id']
         command = job['command']
         
         print(f"[{self.worker_id}] Processing job '{job_id}': {command}")
         
+        log_path = self._log_path(job_id)
+        
         try:
-            # Execute command
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 minute timeout
-            )
+            # Execute command, streaming stdout and stderr to the job's log file
+            with open(log_path, 'wb') as log_file:
+                proc = await asyncio.create_subprocess_shell(
+                    command,
+                    stdout=log_file,
+                    stderr=asyncio.subprocess.STDOUT
+                )
+            
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=self._timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
             
-            if result.returncode == 0:
+            output = self._read_tail(log_path)
+            
+            if proc.returncode == 0:
                 # Job succeeded
                 print(f"[{self.worker_id}] Job '{job_id}' completed successfully")
-                self.queue_manager.update_job(job_id, {
-                    'state': 'completed',
-                    'output': result.stdout
-                })
+                await self._db(self.queue_manager.mark_completed, job_id, output)
             else:
                 # Job failed
-                self._handle_failure(job, f"Command exited with code {result.returncode}: {result.stderr}")
+                await self._record_failure(job, f"Command exited with code {proc.returncode}: {output}")
                 
-        except subprocess.TimeoutExpired:
-            self._handle_failure(job, "Job timed out after 5 minutes")
+        except asyncio.TimeoutError:
+            await self._record_failure(job, f"Job timed out after {self._timeout} seconds")
+        except Exception as e:
+            await self._record_failure(job, f"Execution error: {str(e)}")
+        finally:
+            slots.release()
+    
+    async def _record_failure(self, job, error_message):
+        """Record a failed run; errors are logged so they never escape the job task"""
+        try:
+            await self._db(self._handle_failure, job, error_message)
         except Exception as e:
-            self._handle_failure(job, f"Execution error: {str(e)}")
+            print(f"[{self.worker_id}] Error recording failure of job '{job['id']}': {e}")
     
     def _handle_failure(self, job, error_message):
         """Handle job failure with retry logic"""
         job_id = job['id']
         attempts = job['attempts'] + 1
-        max_retries = job['max_retries']
+        max_retries = job['max_retries'] if job['max_retries'] is not None else self._max_retries_default
         
         print(f"[{self.worker_id}] Job '{job_id}' failed (attempt {attempts}/{max_retries}): {error_message}")
         
         if attempts >= max_retries:
             # Move to DLQ
             print(f"[{self.worker_id}] Job '{job_id}' moved to DLQ after {attempts} attempts")
-            self.queue_manager.update_job(job_id, {
-                'state': 'dead',
-                'attempts': attempts,
-                'error_message': error_message
-            })
+            self.queue_manager.mark_dead(job_id, attempts, error_message)
         else:
             # Schedule retry with exponential backoff
-            backoff_base = self.config.get('backoff_base')
-            delay = backoff_base ** attempts
-            next_retry_at = (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat().replace('+00:00', 'Z')
+            delay = self._backoff_base ** attempts
+            next_retry_at = now_ms() + int(delay * 1000)
             
             print(f"[{self.worker_id}] Job '{job_id}' will retry in {delay} seconds")
             
-            self.queue_manager.update_job(job_id, {
-                'state': 'failed',
-                'attempts': attempts,
-                'next_retry_at': next_retry_at,
-                'error_message': error_message
-            })
+            self.queue_manager.mark_failed_retry(job_id, attempts, next_retry_at, error_message)